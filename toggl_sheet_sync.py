@@ -1,13 +1,18 @@
 #!/usr/bin/env python
 
 import argparse
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, date, timedelta
-import dateutil.parser
 import toggl
 import logging
 import json
 import pytz
+import requests
+from requests.adapters import HTTPAdapter
+import time
 import gspread
+from gspread.utils import rowcol_to_a1
 from oauth2client.service_account import ServiceAccountCredentials
 
 service_scope = ['https://spreadsheets.google.com/feeds']
@@ -20,26 +25,57 @@ def fd(d):
     d = localtz.localize(d)
     return d.isoformat()
 
-def get_entries(start_date, end_date, client=None):
-    finished = False
-    start_search, end_search = start_date, end_date
-    # TODO: This is a manual way to search through time entry list pages. Switch to reports API rather
-    if client:
-        projects = toggl.ProjectList()
-        valid_project_ids = {project['id'] for project in projects if project.get('cid', None) == client['id']}
-    while not finished:
-        search_list = toggl.TimeEntryList(start_search, end_search)
-        max_date = None
-        for toggl_entry in search_list:
-            entry_end = toggl_entry.get('end')
-            if entry_end > max_date:
-                max_date = entry_end
-            if not client or toggl_entry.get('pid') in valid_project_ids:
-                yield toggl_entry
-        if len(search_list.time_entries) < 1000:
-            finished = True
-        else:
-            start_search = max_date + timedelta(seconds=1)
+def parse_iso(s):
+    """Parses the RFC3339 timestamps toggl returns; much faster than the general dateutil parser"""
+    return datetime.fromisoformat(s[:-1] + '+00:00') if s.endswith('Z') else datetime.fromisoformat(s)
+
+TOGGL_REPORTS_URL = 'https://api.track.toggl.com/reports/api/v2/details'
+
+# pooled session so concurrent page fetches reuse connections instead of redoing the TLS handshake
+toggl_session = requests.Session()
+toggl_session.mount('https://', HTTPAdapter(pool_connections=10, pool_maxsize=20))
+
+def get_entries(start_date, end_date, workspace_id, project_ids=None):
+    """Yields time entries between the given dates from the toggl reports API, optionally filtered to project_ids"""
+    params = {
+        'workspace_id': workspace_id,
+        'user_agent': 'toggl-sheet',
+        'since': start_date.strftime('%Y-%m-%d'),
+        'until': (end_date - timedelta(days=1)).strftime('%Y-%m-%d'),
+        'page': 1,
+    }
+    if project_ids is not None:
+        if not project_ids:
+            # an empty project_ids param means "no filter" to the reports API; a client with no projects has no entries
+            return
+        # filtering server-side means we never download other clients' entries at all
+        params['project_ids'] = ','.join(str(project_id) for project_id in sorted(project_ids))
+    while True:
+        response = toggl_session.get(TOGGL_REPORTS_URL, params=params, auth=toggl.Config().get_auth())
+        response.raise_for_status()
+        data = response.json().get('data', [])
+        if not data:
+            break
+        for report_entry in data:
+            yield {'id': report_entry.get('id'), 'pid': report_entry.get('pid'),
+                   'description': report_entry.get('description'),
+                   'start': report_entry.get('start'), 'stop': report_entry.get('end'),
+                   'duration': report_entry.get('dur') // 1000}
+        params['page'] += 1
+
+MAX_RETRIES = 6
+
+def with_retry(fn, *args, **kwargs):
+    """Calls fn(*args, **kwargs), retrying with exponential backoff on transient Sheets API errors"""
+    for attempt in range(1, MAX_RETRIES + 1):
+        try:
+            return fn(*args, **kwargs)
+        except gspread.exceptions.APIError as error:
+            if attempt == MAX_RETRIES or error.response.status_code not in (429, 500, 502, 503, 504):
+                raise
+            delay = min(2 ** attempt, 60)
+            logging.warning("Retrying %s in %ds after Sheets API error: %s", getattr(fn, '__name__', fn), delay, error)
+            time.sleep(delay)
 
 def get_or_add_worksheet(spreadsheet, sheet_name, rows=1000, cols=20):
     try:
@@ -48,24 +84,24 @@ def get_or_add_worksheet(spreadsheet, sheet_name, rows=1000, cols=20):
         return spreadsheet.add_worksheet(sheet_name, rows, cols)
 
 SHEET_HEADERS = ['Date', 'toggl_id', 'Start', 'End', 'Project', 'Description', 'Duration']
+HEADER_IDX = {header: n for n, header in enumerate(SHEET_HEADERS)}
+TID_IDX = HEADER_IDX['toggl_id']
+# columns whose sheet values carry a leading ' to force text formatting
+QUOTE_IDX = {HEADER_IDX['Project'], HEADER_IDX['Description']}
 SUMMARY_HEADERS = ['Period', 'Days Worked', 'Total Hours']
 
 def format_time(t):
-    s = t.strftime("%H:%M").lstrip('0')
-    return '0' + s if s.startswith(':') else s
-
-def entry_to_sheet_row(entry):
-    start_time = dateutil.parser.parse(entry.get('start')) if entry.get('start') else None
-    end_time = dateutil.parser.parse(entry.get('stop')) if entry.get('stop') else None
-    start_time = localtz.fromutc(start_time.replace(tzinfo=None))
-    end_time = localtz.fromutc(end_time.replace(tzinfo=None))
-    duration = end_time - start_time
-    duration = duration.days * 86400 + duration.seconds
-    if duration != entry.get('duration'):
-        raise ValueError("Error checking duration: Calculated %r not %r", duration, entry.get('duration'))
-    project = toggl.ProjectList().find_by_id(entry.get('pid')) if entry.get('pid') else None
+    # direct attribute formatting avoids a locale-aware strftime call per entry
+    return '%d:%02d' % (t.hour, t.minute)
+
+def entry_to_sheet_row(entry, start_time, end_time, project):
+    duration = entry.get('duration')
+    if __debug__:
+        calculated = end_time - start_time
+        calculated = calculated.days * 86400 + calculated.seconds
+        assert calculated == duration, "Error checking duration: Calculated %r not %r" % (calculated, duration)
     return {
-        'Date': start_time.strftime('%Y-%m-%d'),
+        'Date': '%04d-%02d-%02d' % (start_time.year, start_time.month, start_time.day),
         'toggl_id': entry.get('id'),
         'Start': format_time(start_time),
         'End': format_time(end_time),
@@ -74,24 +110,19 @@ def entry_to_sheet_row(entry):
         'Duration': '%d:%02d' % divmod(duration//60, 60)
     }
 
-def cell_name(row, col):
-    col_name = chr(ord('A') + col-1) if col <= 26 else (chr(ord('A') + (col-1)/26) + chr(ord('A') + (col-1) % 26))
-    return "%s%d" % (col_name, row)
-
-def setup_header(worksheet, headers=SHEET_HEADERS):
-    header_cells = []
-    header_row = worksheet.row_values(1)
+def setup_header(worksheet, headers=SHEET_HEADERS, header_row=None):
+    """Checks the existing header row against headers, returning True if it needs writing; raises on a mismatch"""
+    if header_row is None:
+        header_row = worksheet.row_values(1)
+    missing = 0
     for n, header in enumerate(headers):
         h_value = header_row[n] if len(header_row) > n else None
         if not h_value:
-            h = worksheet.cell(1, n+1)
-            h.value = header
-            header_cells.append(h)
+            missing += 1
         if h_value and h_value != header:
-            raise ValueError("Header cell %s at %s doesn't match %s" % (h_value, cell_name(1, n+1), header))
-    logging.info("Updating %d header cells in %s", len(header_cells), worksheet.title)
-    if header_cells:
-        worksheet.update_cells(header_cells)
+            raise ValueError("Header cell %s at %s doesn't match %s" % (h_value, rowcol_to_a1(1, n+1), header))
+    logging.info("Updating %d header cells in %s", missing, worksheet.title)
+    return missing > 0
 
 def start_of_week(d):
     """Returns the starting day of the week for the given datetime"""
@@ -99,72 +130,115 @@ def start_of_week(d):
 
 def sync_sheets(spreadsheet, year, client=None):
     today = datetime.today()
-    months = reversed(range(1, today.month+1 if today.year == year else 13))
+    months = list(reversed(range(1, today.month+1 if today.year == year else 13)))
+    project_by_id = {project['id']: project for project in toggl.ProjectList()}
+    workspace_id = toggl.User().get('default_wid')
+    project_ids = {project_id for project_id, project in project_by_id.items()
+                   if project.get('cid', None) == client['id']} if client else None
     weekly_summary = get_or_add_worksheet(spreadsheet, "Weekly Summary")
-    setup_header(weekly_summary, SUMMARY_HEADERS)
     monthly_summary = get_or_add_worksheet(spreadsheet, "Monthly Summary")
-    setup_header(monthly_summary, SUMMARY_HEADERS)
-    summary_weeks = {}
+    month_sheets = {month: get_or_add_worksheet(spreadsheet, datetime(year=year, month=month, day=1).strftime("%b"))
+                    for month in months}
+    header_sheets = [(weekly_summary, SUMMARY_HEADERS), (monthly_summary, SUMMARY_HEADERS)] + \
+                    [(month_sheets[month], SHEET_HEADERS) for month in months]
+    logging.info("Fetching existing spreadsheet data for %s", ", ".join(month_sheets[month].title for month in months))
+    # open-ended ranges let the server trim to the used rows instead of sending the full grid
+    last_col = rowcol_to_a1(1, len(SHEET_HEADERS)).rstrip('1')
+    ranges = ["'%s'!1:1" % sheet.title for sheet, headers in header_sheets] + \
+             ["'%s'!A2:%s" % (month_sheets[month].title, last_col) for month in months]
+    batch_values = with_retry(spreadsheet.values_batch_get, ranges=ranges)
+    value_ranges = batch_values['valueRanges']
+    header_updates = []
+    for (sheet, headers), value_range in zip(header_sheets, value_ranges):
+        header_row = value_range.get('values', [[]])[0]
+        if setup_header(sheet, headers, header_row):
+            header_updates.append({'range': "'%s'!A1" % sheet.title, 'values': [list(headers)]})
+    if header_updates:
+        with_retry(spreadsheet.values_batch_update, body={'valueInputOption': 'USER_ENTERED', 'data': header_updates})
+    month_values = {month: value_range.get('values', [])
+                    for month, value_range in zip(months, value_ranges[len(header_sheets):])}
+    summary_weeks = defaultdict(int)
     summary_months = {}
-    for month in months:
+
+    def sync_month(month):
+        """Synchronizes one month's entries into its sheet, returning {week: duration} totals for the month"""
+        week_durations = defaultdict(int)
         start_date = datetime(year=year, month=month, day=1)
         end_date = (start_date + timedelta(days=32)).replace(day=1)
-        month_sheet = get_or_add_worksheet(spreadsheet, start_date.strftime("%b"))
-        setup_header(month_sheet)
+        month_sheet = month_sheets[month]
         toggl_id_map = {}
         append_row = 2
         update_cells = []
         added, updated, unchanged = 0, 0, 0
-        logging.info("Fetching toggl data for %s", month_sheet.title)
-        month_entries = list(get_entries(start_date, end_date, client))
-        logging.info("Fetching existing spreadsheet data for %s", month_sheet.title)
-        full_range = month_sheet.range("%s:%s" % (month_sheet.get_addr_int(2, 1),
-                                                  month_sheet.get_addr_int(month_sheet.row_count, len(SHEET_HEADERS))))
+        sheet_rows = month_sheet.row_count
+        # build the cell buffer from the batched fetch, which only covers the sheet's used rows
+        values = month_values[month]
+        full_range = []
+        for row_num in range(2, len(values) + 2):
+            row_values = values[row_num-2]
+            full_range.extend(gspread.models.Cell(row_num, col, value=row_values[col-1] if col-1 < len(row_values) else '')
+                              for col in range(1, len(SHEET_HEADERS)+1))
         def get_row(row_num):
-            if 2 <= row_num <= month_sheet.row_count:
-                start_cell = (row_num-2)*len(SHEET_HEADERS)
-                cells = full_range[start_cell:start_cell+len(SHEET_HEADERS)]
-            else:
-                cells = month_sheet.range("%s:%s" % (month_sheet.get_addr_int(row_num, 1),
-                                                     month_sheet.get_addr_int(row_num, len(SHEET_HEADERS))))
+            start_cell = (row_num-2)*len(SHEET_HEADERS)
+            # extend with empty cells on demand so appended rows also come out of the in-memory buffer
+            while len(full_range) < start_cell + len(SHEET_HEADERS):
+                next_row = full_range[-1].row + 1 if full_range else 2
+                full_range.extend(gspread.models.Cell(next_row, col, value='') for col in range(1, len(SHEET_HEADERS)+1))
+            cells = full_range[start_cell:start_cell+len(SHEET_HEADERS)]
             assert len(cells) == len(SHEET_HEADERS)
             for n, cell in enumerate(cells):
                 assert cell.row == row_num
                 assert cell.col == n + 1
             return cells
 
-        for row_num in range(2, month_sheet.row_count+1):
-            row_cells = get_row(row_num)
-            sheet_row = {SHEET_HEADERS[n]: row_cells[n].value for n in range(len(SHEET_HEADERS))}
-            if sheet_row['toggl_id']:
-                toggl_id_map[int(sheet_row['toggl_id'])] = row_num, sheet_row
+        def flush_cells():
+            nonlocal sheet_rows
+            logging.info("Sending %d cells to sheet", len(update_cells))
+            max_row = max(cell.row for cell in update_cells)
+            if max_row > sheet_rows:
+                with_retry(month_sheet.resize, rows=max_row)
+                sheet_rows = max_row
+            with_retry(month_sheet.update_cells, update_cells)
+            del update_cells[:]
+
+        for i in range(0, len(full_range), len(SHEET_HEADERS)):
+            tid = full_range[i+TID_IDX].value
+            if tid:
+                row_num = full_range[i].row
+                row_cells = full_range[i:i+len(SHEET_HEADERS)]
+                # normalize the row the same way the comparison loop does, so unchanged rows can be skipped outright
+                row_values = tuple(int(cell.value) if n == TID_IDX else
+                                   ("'" + cell.value if n in QUOTE_IDX and cell.value else cell.value)
+                                   for n, cell in enumerate(row_cells))
+                toggl_id_map[int(tid)] = row_num, row_cells, row_values
                 if row_num >= append_row:
                     append_row = row_num + 1
-        logging.info("Synchronizing data")
-        for time_entry in month_entries:
-            if time_entry.get('start'):
-                start_time = localtz.fromutc(dateutil.parser.parse(time_entry.get('start')).replace(tzinfo=None))
-                week = start_of_week(start_time)
-                summary_weeks.setdefault(week, 0)
-                summary_weeks[week] += time_entry.get('duration')
-                summary_months.setdefault(month, 0)
-                summary_months[month] += time_entry.get('duration')
+        logging.info("Synchronizing toggl data for %s", month_sheet.title)
+        for time_entry in get_entries(start_date, end_date, workspace_id, project_ids):
+            start_time = parse_iso(time_entry.get('start')).astimezone(localtz) if time_entry.get('start') else None
+            end_time = parse_iso(time_entry.get('stop')).astimezone(localtz) if time_entry.get('stop') else None
+            if start_time:
+                week_durations[start_of_week(start_time)] += time_entry.get('duration')
             toggl_id = time_entry.get('id')
-            sheet_values = entry_to_sheet_row(time_entry)
+            project = project_by_id.get(time_entry.get('pid')) if time_entry.get('pid') else None
+            sheet_values = entry_to_sheet_row(time_entry, start_time, end_time, project)
             if toggl_id in toggl_id_map:
-                row, sheet_row = toggl_id_map[toggl_id]
-                cell_list = get_row(row)
+                row, cell_list, row_values = toggl_id_map[toggl_id]
+                if row_values == tuple(sheet_values[header] for header in SHEET_HEADERS):
+                    unchanged += 1
+                    continue
                 was_changed = False
-                for n, (header, update_cell) in enumerate(zip(SHEET_HEADERS, cell_list)):
-                    cell_value = sheet_row[header]
-                    if header == 'toggl_id':
+                for n, update_cell in enumerate(cell_list):
+                    header = SHEET_HEADERS[n]
+                    cell_value = update_cell.value
+                    if n == TID_IDX:
                         cell_value = int(cell_value)
-                    elif header in ("Project", "Description") and cell_value:
+                    elif n in QUOTE_IDX and cell_value:
                         cell_value = "'" + cell_value
                     if cell_value != sheet_values[header]:
                         update_cell.value = sheet_values[header]
                         logging.info("Mismatch on id %s at %s on %s: %r %r", toggl_id,
-                                     month_sheet.get_addr_int(row, n+1), header, cell_value, sheet_values[header])
+                                     rowcol_to_a1(row, n+1), header, cell_value, sheet_values[header])
                         update_cells.append(update_cell)
                         was_changed = True
                 if was_changed:
@@ -182,31 +256,35 @@ def sync_sheets(spreadsheet, year, client=None):
             if (added + updated + unchanged) % 100 == 0:
                 logging.info("Added %d, updated %d, didn't change %d rows", added, updated, unchanged)
             if len(update_cells) > 250:
-                logging.info("Sending %d cells to sheet", len(update_cells))
-                month_sheet.update_cells(update_cells)
-                del update_cells[:]
+                flush_cells()
         if update_cells:
-            logging.info("Sending %d cells to sheet", len(update_cells))
-            month_sheet.update_cells(update_cells)
-    week_cells = weekly_summary.range("%s:%s" % (weekly_summary.get_addr_int(2, 1),
-                                                weekly_summary.get_addr_int(len(summary_weeks)+2, len(SUMMARY_HEADERS))))
-    month_cells = monthly_summary.range("%s:%s" % (monthly_summary.get_addr_int(2, 1),
-                                                   monthly_summary.get_addr_int(len(summary_months) + 2,
-                                                                                len(SUMMARY_HEADERS))))
+            flush_cells()
+        return week_durations
+
+    # months are independent and the work is all network I/O, so run them concurrently (bounded for rate limits)
+    with ThreadPoolExecutor(max_workers=5) as executor:
+        for month, week_durations in zip(months, executor.map(sync_month, months)):
+            for week, duration in week_durations.items():
+                summary_weeks[week] += duration
+            if week_durations:
+                summary_months[month] = sum(week_durations.values())
     logging.info("Updating summary cells")
-    for n, (week, duration) in enumerate(sorted(summary_weeks.items())):
-        minutes = duration // 60
-        logging.info("Week starting %s had %d minutes", week.strftime("%Y-%m-%d"), minutes)
-        week_cells[n * len(SUMMARY_HEADERS) + 0].value = week.strftime("%Y-%m-%d")
-        week_cells[n * len(SUMMARY_HEADERS) + 2].value = "'%d:%02d" % (minutes//60, minutes%60)
-    weekly_summary.update_cells(week_cells)
-    for n, (month, duration) in enumerate(sorted(summary_months.items())):
-        minutes = duration // 60
-        month_start = datetime(year, month, 1)
-        logging.info("Month %s had %d minutes", month_start.strftime("%Y-%m (%b)"), minutes)
-        month_cells[n * len(SUMMARY_HEADERS) + 0].value = month_start.strftime("%Y-%m (%b)")
-        month_cells[n * len(SUMMARY_HEADERS) + 2].value = "'%d:%02d" % (minutes // 60, minutes % 60)
-    monthly_summary.update_cells(month_cells)
+    summary_data = []
+    # write only the Period and Total Hours columns, leaving any manual Days Worked entries untouched
+    for worksheet, rows in [(weekly_summary, [(week.strftime("%Y-%m-%d"), duration)
+                                              for week, duration in sorted(summary_weeks.items())]),
+                            (monthly_summary, [(datetime(year, month, 1).strftime("%Y-%m (%b)"), duration)
+                                               for month, duration in sorted(summary_months.items())])]:
+        if not rows:
+            continue
+        for period, duration in rows:
+            logging.info("%s: %s had %d minutes", worksheet.title, period, duration // 60)
+        summary_data.append({'range': "'%s'!A2:A%d" % (worksheet.title, len(rows)+1),
+                             'values': [[period] for period, duration in rows]})
+        summary_data.append({'range': "'%s'!C2:C%d" % (worksheet.title, len(rows)+1),
+                             'values': [["'%d:%02d" % divmod(duration // 60, 60)] for period, duration in rows]})
+    if summary_data:
+        with_retry(spreadsheet.values_batch_update, body={'valueInputOption': 'USER_ENTERED', 'data': summary_data})
 
 
 def main():
@@ -222,6 +300,8 @@ def main():
     client = toggl.ClientList().find_by_name(options.client) if options.client else None
     credentials = ServiceAccountCredentials.from_json_keyfile_name(options.credentials, service_scope)
     c = gspread.authorize(credentials)
+    # the month threads share this session, so give it a pool big enough to keep connections alive
+    c.session.mount('https://', HTTPAdapter(pool_connections=10, pool_maxsize=20))
     spreadsheet = c.open_by_url(options.spreadsheet)
     sync_sheets(spreadsheet, options.year, client)
 